@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -122,3 +123,22 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Audit log
+# Token issuance, exchange, userinfo and failure events, written as JSON lines
+# by a background thread. Override the path via the environment in deployments.
+
+AUDIT_LOG_ENABLED = os.environ.get('AUDIT_LOG_ENABLED', '1').strip().lower() not in {'0', 'false', 'no', 'off'}
+
+AUDIT_LOG_PATH = os.environ.get('AUDIT_LOG_PATH', str(BASE_DIR / 'logs' / 'audit.jsonl'))
+
+AUDIT_LOG_MAX_BYTES = 10 * 1024 * 1024  # Rotate once a file reaches this size
+
+AUDIT_LOG_BACKUP_COUNT = 5
+
+AUDIT_LOG_QUEUE_SIZE = 10000  # Events beyond this are dropped and counted
+
+AUDIT_LOG_BATCH_SIZE = 256
+
+AUDIT_LOG_FSYNC_INTERVAL = 1.0  # Seconds between batched fsyncs
@@ -0,0 +1,355 @@
+"""
+审计日志
+将授权码签发、令牌兑换、用户信息调用及失败事件以 JSON Lines 格式异步写入本地轮转文件。
+
+请求路径上只做一次 put_nowait（微秒级），序列化、写盘、轮转和 fsync
+全部在后台线程中完成；队列满时直接丢弃事件并计数，不阻塞请求。
+"""
+import atexit
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import weakref
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，轮转不加跨进程锁
+    fcntl = None
+
+
+# 这些字段是凭据，只记录其 SHA-256 指纹，且在后台线程中计算
+SENSITIVE_FIELDS = frozenset({'code', 'access_token'})
+
+# 字符串字段入队前的最大长度，防止攻击者提交的超长参数占用队列内存
+FIELD_MAX_LENGTH = 256
+
+
+def _fingerprint(value):
+    """凭据指纹（SHA-256 前 16 位）"""
+    return hashlib.sha256(str(value).encode('utf-8')).hexdigest()[:16]
+
+
+class RotatingJsonlWriter:
+    """
+    按大小轮转的 JSON Lines 文件写入器，批量 fsync（仅由后台线程使用）
+    多个进程可共用同一路径：每批以一次 O_APPEND 写入，写前检查 inode，
+    其他进程轮转后会重新打开；检查、轮转与写入都在文件锁内进行
+    """
+
+    def __init__(self, path, max_bytes, backup_count, fsync_interval):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.fsync_interval = fsync_interval
+        self._fd = None
+        self._lock_fd = None
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if self._lock_fd is None:
+            self._lock_fd = os.open(self.path + '.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def _flock(self, operation):
+        if fcntl is not None:
+            fcntl.flock(self._lock_fd, getattr(fcntl, operation))
+
+    def _reopen_if_rotated(self):
+        """路径已被其他进程轮转（或删除）时重新打开"""
+        try:
+            current = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(self._fd).st_ino:
+            if self._dirty:
+                os.fsync(self._fd)
+                self._dirty = False
+            os.close(self._fd)
+            self._fd = None
+            self._open()
+
+    def _rotate(self):
+        """轮转当前文件（调用方持有文件锁）"""
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._reopen_if_rotated()
+
+    def write_batch(self, lines):
+        """以一次 write 写入一批已编码的行，必要时轮转；满足间隔时 fsync"""
+        if lines:
+            data = b''.join(lines)
+            if self._fd is None:
+                self._open()
+            # 检查、轮转与写入在同一把文件锁内完成，多个进程不会同时越过大小上限
+            self._flock('LOCK_EX')
+            try:
+                self._reopen_if_rotated()
+                size = os.fstat(self._fd).st_size
+                if self.max_bytes and size and size + len(data) > self.max_bytes:
+                    self._rotate()
+                view = memoryview(data)
+                while view:
+                    written = os.write(self._fd, view)
+                    view = view[written:]
+                self._dirty = True
+            finally:
+                self._flock('LOCK_UN')
+        self.maybe_fsync()
+
+    def maybe_fsync(self, force=False):
+        """距上次 fsync 超过间隔（或强制）时同步到磁盘"""
+        if not self._dirty or self._fd is None:
+            return
+        now = time.monotonic()
+        if force or now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._fd)
+            self._dirty = False
+            self._last_fsync = now
+
+    def discard(self):
+        """关闭描述符但不 fsync（fork 后子进程丢弃继承自父进程的描述符）"""
+        for fd in (self._fd, self._lock_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._fd = None
+        self._lock_fd = None
+        self._dirty = False
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                if self._dirty:
+                    os.fsync(self._fd)
+                    self._dirty = False
+            finally:
+                os.close(self._fd)
+                self._fd = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+class AuditLogger:
+    """
+    非阻塞审计日志
+    emit() 将事件放入有界队列，由后台线程批量写入；
+    队列满时丢弃并计入 dropped，编码或写盘失败计入 failed
+    """
+
+    _STOP = object()
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5,
+                 queue_size=10000, batch_size=256, fsync_interval=1.0):
+        self.writer = RotatingJsonlWriter(path, max_bytes, backup_count, fsync_interval)
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+        self.failed = 0
+        self._reported_dropped = 0
+        if hasattr(os, 'register_at_fork'):
+            ref = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: ref() and ref()._after_fork())
+
+    def _after_fork(self):
+        """
+        fork 后在子进程中重建状态
+        继承的锁可能正被父进程的线程持有；继承的文件描述符与父进程共享
+        同一打开文件描述，flock 无法在父子进程间互斥，必须重新打开
+        """
+        writer = self.writer
+        writer.discard()
+        self.writer = RotatingJsonlWriter(
+            writer.path, writer.max_bytes, writer.backup_count, writer.fsync_interval)
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+        self.failed = 0
+        self._reported_dropped = 0
+
+    def emit(self, event, **fields):
+        """记录一条审计事件（请求路径调用，不阻塞）"""
+        # 首次调用时（fork 型 WSGI worker 中为 fork 之后）启动后台线程
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), event, fields))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='idp-audit-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def close(self, timeout=5.0):
+        """停止后台线程，写完队列中剩余事件并 fsync"""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        # 停止信号必须送达，队列满时允许短暂阻塞（仅在进程退出时）；
+        # 磁盘卡住导致超时则放弃，不让 atexit 抛出异常
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def _encode(self, record):
+        ts, event, fields = record
+        data = {'ts': round(ts, 6), 'event': event}
+        for key, value in fields.items():
+            if value is None:
+                continue
+            if key in SENSITIVE_FIELDS:
+                data[key + '_sha256'] = _fingerprint(value)
+            else:
+                data[key] = value
+        return (json.dumps(data, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+
+    def _drop_record(self):
+        """自上次报告以来有丢弃时，生成一条 audit.dropped 事件及对应的累计值"""
+        with self._lock:
+            dropped = self.dropped
+        if dropped == self._reported_dropped:
+            return None, dropped
+        record = (time.time(), 'audit.dropped',
+                  {'count': dropped - self._reported_dropped, 'total': dropped})
+        return record, dropped
+
+    def _next_batch(self):
+        """取出一批事件；收到停止信号时第二个返回值为 True"""
+        batch = []
+        try:
+            item = self._queue.get(timeout=self.fsync_interval)
+        except queue.Empty:
+            return batch, False
+        while True:
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+
+    def _write(self, batch):
+        """逐条编码并写入一批事件，失败的条目计入 failed"""
+        lines = []
+        failed = 0
+        for record in batch:
+            try:
+                lines.append(self._encode(record))
+            except Exception:
+                failed += 1
+
+        drop_record, dropped = self._drop_record()
+        if drop_record is not None:
+            lines.append(self._encode(drop_record))
+
+        try:
+            self.writer.write_batch(lines)
+        except Exception:
+            # 审计写入失败不能影响服务；丢弃报告留待下一批重试
+            failed += len(batch) - failed
+        else:
+            self._reported_dropped = dropped
+        if failed:
+            with self._lock:
+                self.failed += failed
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch, stopping = self._next_batch()
+                self._write(batch)
+            except Exception:
+                # 后台线程不能因意外错误退出，否则之后的事件全部丢失
+                continue
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+
+
+_audit_logger = None
+_audit_logger_lock = threading.Lock()
+
+
+def _reset_lock_after_fork():
+    global _audit_logger_lock
+    _audit_logger_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_lock_after_fork)
+
+
+def get_audit_logger():
+    """按 settings 惰性创建进程内唯一的审计日志实例"""
+    global _audit_logger
+    if _audit_logger is None:
+        with _audit_logger_lock:
+            if _audit_logger is None:
+                _audit_logger = AuditLogger(
+                    path=getattr(settings, 'AUDIT_LOG_PATH',
+                                 os.path.join(settings.BASE_DIR, 'logs', 'audit.jsonl')),
+                    max_bytes=getattr(settings, 'AUDIT_LOG_MAX_BYTES', 10 * 1024 * 1024),
+                    backup_count=getattr(settings, 'AUDIT_LOG_BACKUP_COUNT', 5),
+                    queue_size=getattr(settings, 'AUDIT_LOG_QUEUE_SIZE', 10000),
+                    batch_size=getattr(settings, 'AUDIT_LOG_BATCH_SIZE', 256),
+                    fsync_interval=getattr(settings, 'AUDIT_LOG_FSYNC_INTERVAL', 1.0),
+                )
+                atexit.register(_audit_logger.close)
+    return _audit_logger
+
+
+def reset_audit_logger():
+    """关闭并丢弃当前实例，下次使用时按最新 settings 重新创建（供测试使用）"""
+    global _audit_logger
+    with _audit_logger_lock:
+        logger, _audit_logger = _audit_logger, None
+    if logger is not None:
+        atexit.unregister(logger.close)
+        logger.close()
+
+
+def audit(event, **fields):
+    """记录审计事件；字符串字段截断到 FIELD_MAX_LENGTH 后入队"""
+    if not getattr(settings, 'AUDIT_LOG_ENABLED', True):
+        return
+    for key, value in fields.items():
+        if isinstance(value, str) and len(value) > FIELD_MAX_LENGTH:
+            fields[key] = value[:FIELD_MAX_LENGTH]
+    get_audit_logger().emit(event, **fields)
@@ -1,3 +1,254 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from urllib.parse import urlparse, parse_qs
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+
+from .audit import AuditLogger, RotatingJsonlWriter, reset_audit_logger
+from .models import OIDCClient
+
+
+def read_events(path):
+    """读取审计文件（含轮转备份）中的全部事件"""
+    events = []
+    directory = os.path.dirname(path)
+    for name in sorted(os.listdir(directory)):
+        if name.startswith(os.path.basename(path)) and not name.endswith('.lock'):
+            with open(os.path.join(directory, name)) as f:
+                events.extend(json.loads(line) for line in f)
+    return events
+
+
+class AuditLogTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.path = os.path.join(self.tmpdir, 'audit.jsonl')
+
+
+class EndpointAuditTests(AuditLogTestCase):
+    """端点审计事件"""
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(AUDIT_LOG_ENABLED=True, AUDIT_LOG_PATH=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_audit_logger()
+        self.addCleanup(reset_audit_logger)
+        self.client_obj = OIDCClient.objects.create(
+            client_id='test-client',
+            client_secret='test-secret',
+            redirect_uri='https://example.com/callback',
+        )
+
+    def flush_events(self):
+        reset_audit_logger()
+        return read_events(self.path)
+
+    def test_successful_flow(self):
+        response = self.client.get('/oidc/authorize', {
+            'client_id': 'test-client',
+            'redirect_uri': 'https://example.com/callback',
+            'state': 'xyz',
+        })
+        self.assertEqual(response.status_code, 302)
+        code = parse_qs(urlparse(response['Location']).query)['code'][0]
+
+        response = self.client.post('/oidc/token', {
+            'grant_type': 'authorization_code',
+            'code': code,
+            'client_id': 'test-client',
+            'client_secret': 'test-secret',
+        })
+        self.assertEqual(response.status_code, 200)
+        access_token = response.json()['access_token']
+
+        response = self.client.get('/oidc/userinfo', HTTP_AUTHORIZATION=f'Bearer {access_token}')
+        self.assertEqual(response.status_code, 200)
+
+        events = self.flush_events()
+        self.assertEqual(
+            [e['event'] for e in events],
+            ['authorize.code_issued', 'token.issued', 'userinfo.success'],
+        )
+        self.assertIn('code_sha256', events[0])
+        self.assertIn('code_sha256', events[1])
+        self.assertIn('access_token_sha256', events[1])
+        self.assertIn('access_token_sha256', events[2])
+        self.assertEqual(events[0]['code_sha256'], events[1]['code_sha256'])
+        self.assertEqual(events[2]['client_id'], 'test-client')
+        with open(self.path) as f:
+            raw = f.read()
+        self.assertNotIn(code, raw)
+        self.assertNotIn(access_token, raw)
+
+    def test_replayed_code_matches_issuance(self):
+        response = self.client.get('/oidc/authorize', {
+            'client_id': 'test-client',
+            'redirect_uri': 'https://example.com/callback',
+        })
+        code = parse_qs(urlparse(response['Location']).query)['code'][0]
+        data = {
+            'grant_type': 'authorization_code',
+            'code': code,
+            'client_id': 'test-client',
+            'client_secret': 'test-secret',
+        }
+        self.assertEqual(self.client.post('/oidc/token', data).status_code, 200)
+        self.assertEqual(self.client.post('/oidc/token', data).status_code, 400)
+
+        issued, exchanged, replayed = self.flush_events()
+        self.assertEqual(replayed['event'], 'token.failure')
+        self.assertEqual(replayed['error'], 'invalid_grant')
+        self.assertEqual(replayed['code_sha256'], issued['code_sha256'])
+
+    def test_failure_event(self):
+        response = self.client.post('/oidc/token', {
+            'grant_type': 'authorization_code',
+            'code': 'bogus',
+            'client_id': 'test-client',
+            'client_secret': 'wrong-secret',
+        })
+        self.assertEqual(response.status_code, 400)
+
+        events = self.flush_events()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['event'], 'token.failure')
+        self.assertEqual(events[0]['error'], 'invalid_client')
+        self.assertEqual(events[0]['status'], 400)
+        self.assertEqual(events[0]['client_id'], 'test-client')
+
+    def test_long_fields_truncated(self):
+        response = self.client.get('/oidc/authorize', {
+            'client_id': 'x' * 5000,
+            'redirect_uri': 'https://example.com/callback',
+        })
+        self.assertEqual(response.status_code, 400)
+
+        events = self.flush_events()
+        self.assertEqual(events[0]['event'], 'authorize.failure')
+        self.assertEqual(len(events[0]['client_id']), 256)
+
+
+class AuditLoggerTests(AuditLogTestCase):
+    """后台写入线程"""
+
+    def test_queue_full_counts_drops(self):
+        logger = AuditLogger(self.path, queue_size=1, fsync_interval=0.05)
+        release = threading.Event()
+        write_batch = logger.writer.write_batch
+
+        def stalled_write_batch(lines):
+            release.wait(5)
+            write_batch(lines)
+
+        logger.writer.write_batch = stalled_write_batch
+        for i in range(10):
+            logger.emit('token.issued', n=i)
+        self.assertGreaterEqual(logger.dropped, 8)
+
+        release.set()
+        logger.close()
+        dropped = [e for e in read_events(self.path) if e['event'] == 'audit.dropped']
+        self.assertEqual(sum(e['count'] for e in dropped), logger.dropped)
+        self.assertEqual(dropped[-1]['total'], logger.dropped)
+
+    def test_bad_record_does_not_kill_writer(self):
+        class Unprintable:
+            def __str__(self):
+                raise RuntimeError('boom')
+
+        logger = AuditLogger(self.path, fsync_interval=0.05)
+        logger.emit('good', n=1)
+        logger.emit('bad', code=Unprintable())
+        logger.emit('good', n=2)
+        logger.emit('bytes', code=b'xx')
+        logger.close()
+
+        events = read_events(self.path)
+        self.assertEqual([e['event'] for e in events], ['good', 'good', 'bytes'])
+        self.assertEqual(logger.failed, 1)
+        self.assertEqual(logger.dropped, 0)
+
+    def test_rotation_respects_limits(self):
+        logger = AuditLogger(self.path, max_bytes=500, backup_count=2,
+                             batch_size=1, fsync_interval=0.05)
+        for i in range(100):
+            logger.emit('token.issued', client_id='test-client', n=i)
+        logger.close()
+
+        names = sorted(os.listdir(self.tmpdir))
+        self.assertEqual(names, ['audit.jsonl', 'audit.jsonl.1', 'audit.jsonl.2', 'audit.jsonl.lock'])
+        for name in names:
+            self.assertLessEqual(os.path.getsize(os.path.join(self.tmpdir, name)), 500)
+        # 最新的事件保留在当前文件末尾
+        with open(self.path) as f:
+            self.assertEqual(json.loads(f.readlines()[-1])['n'], 99)
+
+    def test_shared_path_rotation(self):
+        """多个写入器（模拟多个 worker 进程）共用同一路径"""
+        writers = [RotatingJsonlWriter(self.path, 1000, 50, 0.05) for _ in range(2)]
+        for i in range(100):
+            line = json.dumps({'event': 'token.issued', 'n': i}).encode('utf-8') + b'\n'
+            writers[i % 2].write_batch([line])
+        for writer in writers:
+            writer.close()
+
+        for name in os.listdir(self.tmpdir):
+            self.assertLessEqual(os.path.getsize(os.path.join(self.tmpdir, name)), 1000)
+        self.assertEqual(sorted(e['n'] for e in read_events(self.path)), list(range(100)))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_forked_workers_rotation(self):
+        """fork 前已打开文件的日志实例，父子进程同时写入时仍遵守轮转上限"""
+        logger = AuditLogger(self.path, max_bytes=3000, backup_count=100,
+                             batch_size=4, fsync_interval=0.01)
+        logger.emit('parent.start')
+        while not os.path.exists(self.path + '.lock'):
+            time.sleep(0.01)
+
+        # fork 时锁被父进程的其他线程持有，子进程的 emit 不能因此卡住
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with logger._lock:
+                locked.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait(5)
+        pid = os.fork()
+        if pid:
+            release.set()
+            holder.join()
+        if pid == 0:
+            status = 1
+            try:
+                signal.alarm(10)
+                for i in range(500):
+                    logger.emit('child', n=i)
+                logger.close()
+                status = 0
+            finally:
+                os._exit(status)
+
+        for i in range(500):
+            logger.emit('parent', n=i)
+        logger.close()
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+        for name in os.listdir(self.tmpdir):
+            self.assertLessEqual(os.path.getsize(os.path.join(self.tmpdir, name)), 3000)
+        events = read_events(self.path)
+        self.assertEqual(len(events), 1001)
+        self.assertEqual(sorted(e['n'] for e in events if e['event'] == 'child'), list(range(500)))
+        self.assertEqual(sorted(e['n'] for e in events if e['event'] == 'parent'), list(range(500)))
@@ -5,6 +5,7 @@ from django.utils import timezone
 from datetime import timedelta
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 from .models import OIDCClient, AuthorizationCode, AccessToken
+from .audit import audit
 
 
 def get_base_url(request):
@@ -14,6 +15,16 @@ def get_base_url(request):
     return f"{scheme}://{host}"
 
 
+def error_response(request, event, error, description, status=400, **audit_fields):
+    """返回 OAuth 错误响应，并记录失败审计事件"""
+    audit(event, error=error, status=status,
+          remote_addr=request.META.get('REMOTE_ADDR'), **audit_fields)
+    return JsonResponse({
+        'error': error,
+        'error_description': description
+    }, status=status)
+
+
 @require_http_methods(["GET"])
 def authorization_endpoint(request):
     """
@@ -30,33 +41,37 @@ def authorization_endpoint(request):
     
     # 验证必需参数
     if not client_id or not redirect_uri:
-        return JsonResponse({
-            'error': 'invalid_request',
-            'error_description': 'client_id and redirect_uri are required'
-        }, status=400)
+        return error_response(
+            request, 'authorize.failure', 'invalid_request',
+            'client_id and redirect_uri are required',
+            status=400, client_id=client_id
+        )
     
     # 验证响应类型
     if response_type != 'code':
-        return JsonResponse({
-            'error': 'unsupported_response_type',
-            'error_description': 'Only authorization code flow is supported'
-        }, status=400)
+        return error_response(
+            request, 'authorize.failure', 'unsupported_response_type',
+            'Only authorization code flow is supported',
+            status=400, client_id=client_id
+        )
     
     # 验证客户端
     try:
         client = OIDCClient.objects.get(client_id=client_id, is_active=True)
     except OIDCClient.DoesNotExist:
-        return JsonResponse({
-            'error': 'invalid_client',
-            'error_description': 'Invalid client_id'
-        }, status=400)
+        return error_response(
+            request, 'authorize.failure', 'invalid_client',
+            'Invalid client_id',
+            status=400, client_id=client_id
+        )
     
     # 验证重定向 URI
     if redirect_uri != client.redirect_uri:
-        return JsonResponse({
-            'error': 'invalid_request',
-            'error_description': 'redirect_uri mismatch'
-        }, status=400)
+        return error_response(
+            request, 'authorize.failure', 'invalid_request',
+            'redirect_uri mismatch',
+            status=400, client_id=client_id
+        )
     
     # 生成授权码（不进行用户认证，直接生成）
     code = AuthorizationCode.generate_code()
@@ -70,6 +85,9 @@ def authorization_endpoint(request):
         expires_at=timezone.now() + timedelta(minutes=10)  # 授权码有效期 10 分钟
     )
     
+    audit('authorize.code_issued', client_id=client_id, code=code, scope=scope,
+          remote_addr=request.META.get('REMOTE_ADDR'))
+    
     # 构建重定向 URL，添加授权码和状态
     parsed_uri = urlparse(redirect_uri)
     query_params = parse_qs(parsed_uri.query)
@@ -107,62 +125,70 @@ def token_endpoint(request):
     
     # 验证必需参数
     if not grant_type or not code or not client_id or not client_secret:
-        return JsonResponse({
-            'error': 'invalid_request',
-            'error_description': 'grant_type, code, client_id and client_secret are required'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'invalid_request',
+            'grant_type, code, client_id and client_secret are required',
+            status=400, client_id=client_id
+        )
     
     # 验证授权类型
     if grant_type != 'authorization_code':
-        return JsonResponse({
-            'error': 'unsupported_grant_type',
-            'error_description': 'Only authorization_code grant type is supported'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'unsupported_grant_type',
+            'Only authorization_code grant type is supported',
+            status=400, client_id=client_id
+        )
     
     # 验证客户端
     try:
         client = OIDCClient.objects.get(client_id=client_id, is_active=True)
     except OIDCClient.DoesNotExist:
-        return JsonResponse({
-            'error': 'invalid_client',
-            'error_description': 'Invalid client_id'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'invalid_client',
+            'Invalid client_id',
+            status=400, client_id=client_id
+        )
     
     # 验证客户端密钥
     if client_secret != client.client_secret:
-        return JsonResponse({
-            'error': 'invalid_client',
-            'error_description': 'Invalid client_secret'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'invalid_client',
+            'Invalid client_secret',
+            status=400, client_id=client_id
+        )
     
     # 验证授权码
     try:
         auth_code = AuthorizationCode.objects.get(code=code, client=client)
     except AuthorizationCode.DoesNotExist:
-        return JsonResponse({
-            'error': 'invalid_grant',
-            'error_description': 'Invalid authorization code'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'invalid_grant',
+            'Invalid authorization code',
+            status=400, client_id=client_id, code=code
+        )
     
     # 检查授权码是否已使用或过期
     if auth_code.is_used:
-        return JsonResponse({
-            'error': 'invalid_grant',
-            'error_description': 'Authorization code has already been used'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'invalid_grant',
+            'Authorization code has already been used',
+            status=400, client_id=client_id, code=code
+        )
     
     if not auth_code.is_valid():
-        return JsonResponse({
-            'error': 'invalid_grant',
-            'error_description': 'Authorization code has expired'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'invalid_grant',
+            'Authorization code has expired',
+            status=400, client_id=client_id, code=code
+        )
     
     # 验证重定向 URI
     if redirect_uri and redirect_uri != auth_code.redirect_uri:
-        return JsonResponse({
-            'error': 'invalid_grant',
-            'error_description': 'redirect_uri mismatch'
-        }, status=400)
+        return error_response(
+            request, 'token.failure', 'invalid_grant',
+            'redirect_uri mismatch',
+            status=400, client_id=client_id, code=code
+        )
     
     # 标记授权码为已使用
     auth_code.is_used = True
@@ -177,6 +203,9 @@ def token_endpoint(request):
         expires_at=timezone.now() + timedelta(hours=1)  # Token 有效期 1 小时
     )
     
+    audit('token.issued', client_id=client_id, code=code, access_token=access_token,
+          scope=auth_code.scope, remote_addr=request.META.get('REMOTE_ADDR'))
+    
     # 构建响应
     response_data = {
         'access_token': access_token,
@@ -246,25 +275,32 @@ def userinfo_endpoint(request):
         access_token = request.GET.get('access_token') or request.POST.get('access_token')
     
     if not access_token:
-        return JsonResponse({
-            'error': 'invalid_token',
-            'error_description': 'Access token is required'
-        }, status=401)
+        return error_response(
+            request, 'userinfo.failure', 'invalid_token',
+            'Access token is required',
+            status=401
+        )
     
     # 验证访问令牌
     try:
-        token_obj = AccessToken.objects.get(token=access_token)
+        # 同时取出客户端，审计记录 client_id 时不产生额外查询
+        token_obj = AccessToken.objects.select_related('client').get(token=access_token)
     except AccessToken.DoesNotExist:
-        return JsonResponse({
-            'error': 'invalid_token',
-            'error_description': 'Invalid access token'
-        }, status=401)
+        return error_response(
+            request, 'userinfo.failure', 'invalid_token',
+            'Invalid access token',
+            status=401, access_token=access_token
+        )
     
     if not token_obj.is_valid():
-        return JsonResponse({
-            'error': 'invalid_token',
-            'error_description': 'Access token has expired'
-        }, status=401)
+        return error_response(
+            request, 'userinfo.failure', 'invalid_token',
+            'Access token has expired',
+            status=401, access_token=access_token
+        )
+    
+    audit('userinfo.success', client_id=token_obj.client.client_id, access_token=access_token,
+          remote_addr=request.META.get('REMOTE_ADDR'))
     
     # 返回用户信息（简化版本）
     user_info = {